@@ -15,18 +15,57 @@ from argparse import (
     ArgumentParser,
     Namespace,
 )
-from ctypes import CDLL, c_uint8, cdll
-from gzip import compress as gzip_compress, decompress as gzip_decompress
-from lzma import decompress as lzma_decompress
-from os import environ
+from collections import defaultdict
+from collections.abc import Callable, Generator, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractContextManager, closing, contextmanager
+from ctypes import CDLL, Array, c_char, c_uint8, cdll
+from dataclasses import dataclass
+from functools import partial
+from gzip import GzipFile
+from http import HTTPStatus
+from io import BufferedIOBase, BufferedReader, BytesIO, RawIOBase
+from json import dumps as json_dumps, loads as json_loads
+from lzma import open as lzma_open
+from mmap import ACCESS_COPY, mmap
+from os import cpu_count, environ, fstat
 from pathlib import Path
 from pprint import pp as pprint
-from re import MULTILINE, VERBOSE, compile as re_compile
+from re import ASCII, MULTILINE, VERBOSE, compile as re_compile
+from shutil import copyfileobj, which
+from sqlite3 import OperationalError, connect as sqlite_connect
+from subprocess import PIPE, Popen
 from sys import exit, stderr
-from time import time
-from typing import Literal, NamedTuple, TypeAlias
-from urllib.request import urlopen
+from time import perf_counter
+from typing import IO, TYPE_CHECKING, Literal, TypeAlias
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+from zlib import DEFLATED, MAX_WBITS, compressobj, crc32
+
+
+if TYPE_CHECKING:
+    from _typeshed import WriteableBuffer
+
+# ISA-L's gzip decompressor is a few times faster than zlib's. We still compress
+# the database with zlib though since ISA-L's highest compression level produces
+# noticeably larger files, and the database is downloaded by every user.
+if TYPE_CHECKING:
+    from gzip import open as gzip_open
+else:
+    try:
+        from isal.igzip import open as gzip_open
+    except ImportError:
+        from gzip import open as gzip_open
+
+# Zopfli produces gzip files that are a few percent smaller than zlib's, which
+# is worth the much slower compression since LuaTeX can only decompress gzip.
+zopfli_compress: Callable[[bytes], bytes] | None
+if not TYPE_CHECKING:
+    try:
+        from zopfli.gzip import compress as zopfli_compress
+    except ImportError:
+        zopfli_compress = None
 
 
 ########################
@@ -34,8 +73,13 @@ from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
 ########################
 
 
-class FileEntry(NamedTuple):
-    """A file entry in the filename list sources."""
+@dataclass(slots=True, eq=False)
+class FileEntry:
+    """A file entry in the filename list sources.
+
+    Entries are compared and hashed by identity, which is all that we need, and
+    this is faster than a frozen dataclass.
+    """
 
     filename: str
     """The name of the file, without any path components."""
@@ -55,7 +99,8 @@ class FileEntry(NamedTuple):
     unknown."""
 
 
-class CTANRow(NamedTuple):
+@dataclass(slots=True)
+class CTANRow:
     """A row in the exported filename database for a file from CTAN."""
 
     path: str
@@ -68,7 +113,8 @@ class CTANRow(NamedTuple):
     """The hash of the file contents, as bytes."""
 
 
-class ZipRow(NamedTuple):
+@dataclass(slots=True)
+class ZipRow:
     """A row in the exported filename database for a file from the zip file."""
 
     path: str
@@ -84,33 +130,47 @@ class ZipRow(NamedTuple):
     """The byte offset of the start of gzip-compressed file data in the zip file."""
 
     end_offset: int
-    """The byte offset of the end of gzip-compressed file data in the zip file."""
+    """The byte offset of the last byte of gzip-compressed file data in the zip
+    file. This is inclusive, to match HTTP range requests."""
 
 
 DatabaseRow: TypeAlias = CTANRow | ZipRow
 FileList: TypeAlias = dict[str, list[FileEntry]]
+HashCache: TypeAlias = dict[tuple[str, int, int], bytes]
 
 #################
 ### Constants ###
 #################
 
 __VERSION__ = "0.2.2"  # %%version
+# The zip file and database are generated once but downloaded by every user, so
+# the extra time spent on the maximum compression level is well worth it. The
+# database can only use gzip since that's all that LuaTeX can decompress.
+COMPRESSION_LEVEL = 9
 CONTEXT_LENGTH = 8
 DATABASE_FILENAME = "network-install.files.lut.gz"
 DEFAULT_MIRROR = "https://mirror.ctan.org"
+DOWNLOAD_CACHE_NAME = "network-install.downloads"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 FILES_PATH = "/FILES.byname.gz"
-IGNORE_EXTENSIONS = {"pdf", "png", "jpg", "4ht"}
+HASH_CACHE_NAME = "network-install.hashes.sqlite3"
+IGNORE_EXTENSIONS = (".pdf", ".png", ".jpg", ".4ht")
 LIBHYDROGEN_CONTEXT = b"netinst1"
+LUA_ORDINARY_BYTES = bytes(sorted(set(range(256)) - set(b'\r\n"\\')))
+MMAP_THRESHOLD = 1024 * 1024
 SECRET_KEY_LENGTH = 64
 SIGNATURE_LENGTH = 64
-START_TIME = time()
+START_TIME = perf_counter()
 TLPDB_PATH = "/systems/texlive/tlnet/tlpkg/texlive.tlpdb.xz"
-TLPDB_REVISION_REGEX = re_compile(r"^revision (\d+)\s*$", MULTILINE)
-TLPDB_PACKAGE_NAME_REGEX = re_compile(r"^name (\S+)\s*$", MULTILINE)
+WORKER_THREADS = (cpu_count() or 1) * 2
 ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
-ZIP_LOCAL_FILE_HEADER_SIZE = 30
 ZIP_NAME = "network-install.files.zip"
+
+# The LuaTeX side validates every downloaded file with "libhydrogen.hash()", so
+# the hash algorithm and size here can't be changed without also updating
+# "network-install-database.lua".
 HASH_SIZE_BYTES = 16
+HASH_BUFFER = c_uint8 * HASH_SIZE_BYTES
 
 IGNORE_PACKAGES = {
     "lwarp",  # Too many extra files
@@ -119,97 +179,75 @@ IGNORE_PACKAGES = {
     "l3kernel",  # Bad things happen when this doesn't match the format
 }
 
-TLPDB_FILE_REGEX = re_compile(
+CTAN_IGNORE_PREFIXES = (
+    # The latex-dev files are always going to be duplicates of files in the
+    # main archive, so we need to ignore them to avoid accidental duplications.
+    "macros/latex-dev/",
+    # These files are automatically synced from modules.contextgarden.net, so
+    # there can be duplicate files here too.
+    "macros/context/contrib/",
+    # No runtime files in here, and some of the files conflict with files in
+    # the main archive, so we'll just ignore the whole tree.
+    "info/",
+)
+
+# The dates in FILES.byname are in YYYY/MM/DD format.
+CTAN_DATE_REGEX = re_compile(r"\d{4}/\d{2}/\d{2}", ASCII)
+
+# filelist_from_tlpdb() unpacks the groups of this pattern by position, so they
+# need to stay in the same order. The tlpdb only separates fields with ASCII
+# whitespace, so we can skip the slower Unicode-aware character classes.
+TLPDB_REGEX = re_compile(
     r"""
         # Match the beginning of the line
         ^
 
-        # Match a literal space
-        \ #
-
-        # Only match things that look like paths in $TEXMFDIST
-        (texmf-dist | RELOC ) /
-
-        (?P<path>
-            # We only care about files in the following subdirectories.
-            (?P<format>
-                dvips |  # For PSTricks
-                metapost |  # For luamplib
-                scripts |  # Maybe some of the stuff here is used at runtime?
-
-                # TeX
-                tex / (?:
-                    latex | generic | lualatex | luatex
-                ) |
-
-                # Fonts
-                fonts / (?:
-                    tfm | type1 | vf | afm | enc | # Type 1 fonts
-                    cmap | map |  # Map files
-                    opentype | truetype # OpenType and TrueType fonts
-                )
-            ) /
+        (?:
+            # The name of the package, which always begins a new package
+            name \  (?P<name> \S+ ) \s* |
 
-            # Match the rest of the path
-            \S+?
+            # The SVN revision of the package
+            revision \  (?P<revision> \d+ ) \s* |
 
-            # Match the filename
-            / (?P<filename> [^ / \s ]+)
-        )
+            # Or a file in the package, indented with a literal space
+            \ #
 
-        # Match the end of the line
-        $
-    """,
-    VERBOSE | MULTILINE,
-)
+            # Only match things that look like paths in $TEXMFDIST
+            (?: texmf-dist | RELOC ) /
 
-CTAN_FILE_REGEX = re_compile(
-    r"""
-        # Match the beginning of the line
-        ^
+            (?P<path>
+                # We only care about files in the following subdirectories.
+                (?P<format>
+                    dvips |  # For PSTricks
+                    metapost |  # For luamplib
+                    scripts |  # Maybe some of this stuff is used at runtime?
 
-        # The date, in YYYY/MM/DD format
-        (?P<date> \d{4} / \d{2} / \d{2} )
-        \ \|\ # Column separator
+                    # TeX
+                    tex / (?:
+                        latex | generic | lualatex | luatex
+                    ) |
 
-        # The file size, in bytes
-        \s* # Right-aligned
-        (?P<size> \d+ )
-        \ \|\ # Column separator
+                    # Fonts
+                    fonts / (?:
+                        tfm | type1 | vf | afm | enc | # Type 1 fonts
+                        cmap | map |  # Map files
+                        opentype | truetype # OpenType and TrueType fonts
+                    )
+                ) /
 
-        # The file path, relative to the root of the CTAN archive
-        (?P<path>
-            \S+?
+                # Match the rest of the path
+                \S+?
 
-            # Just the filename, without any path components
-            / (?P<filename> [^ / \s ]+ )
+                # Match the filename, which is split off of the path in
+                # Python since that's cheaper than another capture group
+                / [^ / \s ]+
+            )
         )
 
         # Match the end of the line
         $
     """,
-    VERBOSE | MULTILINE,
-)
-
-CTAN_IGNORE_REGEX = re_compile(
-    r"""
-        ^(?:
-            # The latex-dev files are always going to be duplicates of files in
-            # the main archive, so we need to ignore them to avoid accidental
-            # duplications.
-            macros/latex-dev |
-
-            # These files are automatically synced from
-            # modules.contextgarden.net, so there can be duplicate files here
-            # too.
-            macros/context/contrib |
-
-            # No runtime files in here, and some of the files conflict with
-            # files in the main archive, so we'll just ignore the whole tree.
-            info
-        ) /
-    """,
-    VERBOSE | MULTILINE,
+    VERBOSE | MULTILINE | ASCII,
 )
 
 
@@ -225,27 +263,214 @@ def msg(message: str) -> None:
         message: The message to print.
     """
 
+    elapsed = perf_counter() - START_TIME
     print(  # noqa: T201
-        f"\x1b[0;36m[network-install {time() - START_TIME:7.3f}] {message}",
+        f"\x1b[0;36m[network-install {elapsed:7.3f}] {message}",
         file=stderr,
     )
 
 
-def download_file(url: str) -> bytes:
-    """Download a file from the given URL and return its contents as bytes.
+@contextmanager
+def xz_open(compressed: IO[bytes]) -> Generator[IO[bytes], None, None]:
+    """Decompress an xz stream using the external xz program.
+
+    The system xz is usually faster than Python's lzma module, and running it as
+    a separate process lets the decompression run concurrently with the
+    download.
 
     Args:
-        url: The URL to download the file from.
+        compressed: A file object containing the xz-compressed data.
 
-    Returns:
-        The contents of the file as bytes.
+    Yields:
+        A file object containing the decompressed data.
+    """
+
+    def feed(stdin: IO[bytes]) -> None:
+        try:
+            with stdin:
+                copyfileobj(compressed, stdin)
+        except BrokenPipeError:
+            # xz exited before reading all of its input, so it must have
+            # failed. Its exit code is checked below.
+            pass
+
+    with (
+        Popen(
+            ["xz", "--decompress", "--stdout", "--threads=0"],
+            stdin=PIPE,
+            stdout=PIPE,
+        ) as process,
+        ThreadPoolExecutor(max_workers=1) as executor,
+    ):
+        assert process.stdin is not None
+        assert process.stdout is not None
+        feeder = executor.submit(feed, process.stdin)
+        try:
+            yield process.stdout
+        except BaseException:
+            # Make sure that the feeder thread doesn't block forever waiting
+            # for xz to accept more input.
+            process.kill()
+            raise
+
+        # Propagate any errors from the download
+        feeder.result()
+
+    if process.returncode != 0:
+        raise RuntimeError(f"xz failed with exit code {process.returncode}.")
+
+
+class TeeReader(RawIOBase):
+    """A file object that saves a copy of everything that is read from it."""
+
+    def __init__(self, source: BufferedIOBase, copy: IO[bytes]) -> None:
+        """Initialize the reader.
+
+        Args:
+            source: The file object to read from.
+            copy: The file object to write the copy to.
+        """
+
+        self.source = source
+        self.copy = copy
+
+    def readable(self) -> bool:  # noqa: PLR6301
+        """The reader is always readable."""
+        return True
+
+    def readinto(self, buffer: "WriteableBuffer") -> int:
+        """Read data from the source into the buffer, and save a copy of it.
+
+        Args:
+            buffer: The buffer to read into.
+
+        Returns:
+            The number of bytes read.
+        """
+
+        size = self.source.readinto(buffer)
+        self.copy.write(memoryview(buffer)[:size])
+        return size
+
+
+@contextmanager
+def cached_urlopen(
+    url: str, cache_path: Path
+) -> Generator[IO[bytes], None, None]:
+    """Open a URL, reusing a cached copy of the response if it's unchanged.
+
+    The ETag and Last-Modified headers of the response are saved next to the
+    cached copy, and sent with the next request so that the server can tell us
+    if the file has changed since.
+
+    Args:
+        url: The URL to open.
+        cache_path: The path to save the cached copy of the response to.
+
+    Yields:
+        A file object containing the response body.
+    """
+
+    metadata_path = cache_path.with_name(cache_path.name + ".json")
+    partial_path = cache_path.with_name(cache_path.name + ".part")
+
+    # Make a conditional request if we have a cached copy
+    headers: dict[str, str] = {}
+    if cache_path.exists() and metadata_path.exists():
+        metadata = json_loads(metadata_path.read_text())
+        if metadata["etag"]:
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata["last_modified"]:
+            headers["If-Modified-Since"] = metadata["last_modified"]
+
+    try:
+        response = urlopen(Request(url, headers=headers))
+    except HTTPError as error:
+        if error.code != HTTPStatus.NOT_MODIFIED:
+            raise
+
+        # The cached copy is still current. We'll read it outside of the except
+        # block so that any errors while parsing it aren't chained to this one.
+        error.close()
+        response = None
+
+    if response is None:
+        msg(f"Using the cached copy of {url}.")
+        with cache_path.open("rb") as f:
+            yield f
+        return
+
+    # Otherwise, save the response as it's read
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with response, partial_path.open("wb") as f:
+        try:
+            yield BufferedReader(TeeReader(response, f))
+        except BaseException:
+            # Don't keep an incomplete copy around
+            partial_path.unlink(missing_ok=True)
+            raise
+
+        # Make sure that the whole file is saved, even if the caller didn't read
+        # all of it.
+        copyfileobj(response, f)
+
+    # Only replace the cached copy once it's complete
+    metadata_path.unlink(missing_ok=True)
+    partial_path.replace(cache_path)
+    metadata_path.write_text(
+        json_dumps({
+            "etag": response.headers["ETag"],
+            "last_modified": response.headers["Last-Modified"],
+        })
+    )
+
+
+def download_file(
+    url: str,
+    decompressor: Callable[
+        [IO[bytes]], AbstractContextManager[IO[bytes] | BufferedIOBase]
+    ],
+    cache_directory: Path,
+) -> Iterator[str]:
+    """Download a compressed text file from the given URL.
+
+    The file is decompressed and yielded in chunks as it's downloaded, so that
+    the file never needs to be held in memory all at once.
+
+    Args:
+        url: The URL to download the file from.
+        decompressor: A function that wraps a file object containing compressed
+            data and returns a context manager for a file object containing the
+            decompressed data, like gzip.open() or lzma.open().
+        cache_directory: The directory to cache the compressed file in, so
+            that it doesn't need to be downloaded again if it's unchanged.
+
+    Yields:
+        The decompressed contents of the file, in chunks that always end on a
+        line boundary.
     """
 
     msg(f"Downloading {url}...")
-    with urlopen(url) as response:
-        data = response.read()
+    cache_path = cache_directory / url.rpartition("/")[2]
+    with (
+        cached_urlopen(url, cache_path) as response,
+        decompressor(response) as f,
+    ):
+        remainder = b""
+        while True:
+            data = f.read(DOWNLOAD_CHUNK_SIZE)
+            if not data:
+                break
+
+            # Only yield complete lines, and save the partial last line for
+            # the next chunk.
+            data = remainder + data
+            end = data.rfind(b"\n") + 1
+            remainder = data[end:]
+            yield data[:end].decode("utf-8")
+
+        yield remainder.decode("utf-8")
     msg(f"Finished downloading {url}.")
-    return data
 
 
 def lua_string(s: str | bytes) -> bytes:
@@ -261,10 +486,14 @@ def lua_string(s: str | bytes) -> bytes:
     if isinstance(s, str):
         s = s.encode("ascii")
 
-    if (b"\r" in s) or (b"\n" in s):
-        return repr(s)[1:].encode("ascii")
-    elif (b'"' not in s) and (b"\\" not in s):
+    # Find all the characters that need special handling in a single pass,
+    # since most strings don't have any.
+    special = s.translate(None, LUA_ORDINARY_BYTES)
+
+    if not special:
         return b'"' + s + b'"'
+    elif (b"\r" in special) or (b"\n" in special):
+        return repr(s)[1:].encode("ascii")
     elif (b"]]" not in s) and (not s.endswith(b"]")):
         return b"[[" + s + b"]]"
     elif b"]=]" not in s:
@@ -356,7 +585,7 @@ def create_signature(message: bytes, secret_key: bytes) -> bytes:
     return bytes(signature)
 
 
-def hash_message(message: bytes) -> bytes:
+def hash_message(message: bytes | Array[c_char]) -> bytes:
     """Hash the given message using libhydrogen.
 
     Args:
@@ -369,7 +598,9 @@ def hash_message(message: bytes) -> bytes:
     if libhydrogen is None:
         raise RuntimeError("libhydrogen is not initialized.")
 
-    hash = (c_uint8 * HASH_SIZE_BYTES)()
+    # The output buffer can't be shared since this is called from multiple
+    # threads, but we can at least avoid recreating the array type every time.
+    hash = HASH_BUFFER()
     result = libhydrogen.hydro_hash_hash(
         hash,
         HASH_SIZE_BYTES,
@@ -389,34 +620,50 @@ def hash_message(message: bytes) -> bytes:
 ##################################
 
 
-def download_files(mirror_url: str) -> tuple[str, str]:
-    """Download the files from the CTAN mirror.
+def download_filelists(
+    mirror_url: str,
+    cache_directory: Path,
+) -> tuple[FileList, tuple[FileList, FileList]]:
+    """Download and parse the filelists from the CTAN mirror.
 
     Args:
         mirror_url: The CTAN mirror to download from.
+        cache_directory: The directory to cache the downloaded files in.
 
     Returns:
-        A tuple containing the contents of the FILES.byname and texlive.tlpdb files as strings.
+        A tuple containing the filelist extracted from the FILES.byname file,
+        and the tuple of filelists extracted from the texlive.tlpdb file (see
+        filelist_from_tlpdb()).
     """
 
-    # Download the files
-    files_byname_compressed = download_file(mirror_url + FILES_PATH)
-    tlpdb_compressed = download_file(mirror_url + TLPDB_PATH)
-
-    # Decompress the files
-    files_byname = gzip_decompress(files_byname_compressed).decode("utf-8")
-    tlpdb = lzma_decompress(tlpdb_compressed).decode("utf-8")
+    # Download, decompress, and parse the files. These are independent of each
+    # other, so we'll process them concurrently. Each file is parsed as it's
+    # downloaded, so neither file is ever held in memory all at once.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        ctan_files = executor.submit(
+            filelist_from_ctan,
+            download_file(mirror_url + FILES_PATH, gzip_open, cache_directory),
+        )
+        tlpdb_files = executor.submit(
+            filelist_from_tlpdb,
+            download_file(
+                mirror_url + TLPDB_PATH,
+                xz_open if which("xz") else lzma_open,
+                cache_directory,
+            ),
+        )
 
-    return files_byname, tlpdb
+    return ctan_files.result(), tlpdb_files.result()
 
 
 def filelist_from_tlpdb(
-    tlpdb: str,
+    tlpdb: Iterable[str],
 ) -> tuple[FileList, FileList]:
     """Extract the filelist from the tlpdb file.
 
     Args:
-        tlpdb: The contents of the tlpdb file as a string.
+        tlpdb: The contents of the tlpdb file, as chunks of text that each end
+            on a line boundary.
 
     Returns:
         A tuple of two dictionaries mapping file names to their corresponding
@@ -427,292 +674,436 @@ def filelist_from_tlpdb(
         included in the zip file if they're missing from the CTAN filelist.
     """
 
-    all_files: FileList = {}
-    zip_files: FileList = {}
+    all_files: defaultdict[str, list[FileEntry]] = defaultdict(list)
+    zip_files: defaultdict[str, list[FileEntry]] = defaultdict(list)
+
+    # The tlpdb file always lists the name and revision of a package before any
+    # of its files, so we can parse the whole file in a single pass, keeping
+    # track of the current package as we go. This also means that it doesn't
+    # matter if a package is split across multiple chunks.
+    pkg_name: str | None = None
+    revision: int | None = None
+
+    for chunk in tlpdb:
+        for match in TLPDB_REGEX.finditer(chunk):
+            # Fetching all the groups at once is much faster than looking each
+            # of them up by name.
+            name, revision_str, path, file_format = match.groups()
+
+            # Start of a new package
+            if name is not None:
+                pkg_name = name
+                revision = None
+                continue
 
-    for package in tlpdb.split("\n\n"):
-        # Check to see if we should ignore this package
-        pkg_name_match = TLPDB_PACKAGE_NAME_REGEX.search(package)
-        if pkg_name_match is None:
-            if package.strip():
+            # The revision of the current package
+            if revision_str is not None:
+                revision = int(revision_str)
+                continue
+
+            # Otherwise, this is a file in the current package
+            if pkg_name is None:
                 raise ValueError(
                     "Failed to parse package name from tlpdb file."
                 )
-            else:
-                continue
-        pkg_name = pkg_name_match.group(1)
-        if pkg_name in IGNORE_PACKAGES:
-            continue
 
-        # Get the revision of the package
-        revision_match = TLPDB_REVISION_REGEX.search(package)
-        if revision_match is not None:
-            revision = int(revision_match.group(1))
-        else:
-            revision = None
-
-        # Loop over all the files
-        for file_match in TLPDB_FILE_REGEX.finditer(package):
-            filename = file_match.group("filename")
-            path = file_match.group("path")
-            entry = FileEntry(
-                filename=filename,
-                path=path,
-                source="tlpdb",
-                date=None,
-                revision=revision,
-            )
+            # Check to see if we should ignore this package
+            if pkg_name in IGNORE_PACKAGES:
+                continue
 
-            if filename not in all_files:
-                all_files[filename] = []
+            filename = path.rpartition("/")[2]
+            # Positional arguments are about twice as fast as keyword
+            # arguments here, which adds up over this many files.
+            entry = FileEntry(filename, path, "tlpdb", None, revision)
 
             all_files[filename].append(entry)
 
-            if file_match.group("format").startswith("tex/"):
-                if filename not in zip_files:
-                    zip_files[filename] = []
+            # Only TeX files can be included in the zip file, and we'll ignore
+            # files with certain extensions since they're large and are meant to
+            # be included in the CTAN archive as-is.
+            is_tex = file_format.startswith("tex/")
+            if is_tex and not filename.endswith(IGNORE_EXTENSIONS):
                 zip_files[filename].append(entry)
 
+    # Make missing keys raise KeyError again for the callers.
+    all_files.default_factory = None
+    zip_files.default_factory = None
+
     return all_files, zip_files
 
 
 def filelist_from_ctan(
-    files_byname: str,
+    files_byname: Iterable[str],
 ) -> FileList:
     """Extract the filelist from the FILES.byname file.
 
     Args:
-        files_byname: The contents of the FILES.byname file as a string.
+        files_byname: The contents of the FILES.byname file, as chunks of text
+            that each end on a line boundary.
 
     Returns:
         A dictionary mapping file names to their corresponding FileEntry
         objects.
     """
 
-    files: FileList = {}
+    files: defaultdict[str, list[FileEntry]] = defaultdict(list)
+
+    for chunk in files_byname:
+        for line in chunk.splitlines():
+            # Each line is "YYYY/MM/DD |     size | path", and the columns are
+            # fixed enough that we can just split on the separators.
+            date_str, _, rest = line.partition(" | ")
+            size_str, _, path = rest.partition(" | ")
+            directory, _, filename = path.rpartition("/")
+
+            # Skip any malformed lines.
+            if (
+                CTAN_DATE_REGEX.fullmatch(date_str) is None
+                or not size_str.lstrip().isdigit()
+            ):
+                continue
 
-    for file_match in CTAN_FILE_REGEX.finditer(files_byname):
-        # Parse the file information from the regex match
-        filename = file_match.group("filename")
-        path = file_match.group("path")
-        date_str = file_match.group("date")
-        date = int(date_str.replace("/", ""))
+            # Skip anything that isn't a file in a subdirectory, along with
+            # any paths that contain whitespace.
+            if not directory or not filename or path.split() != [path]:
+                continue
 
-        # Special cases: exclude certain files
-        if CTAN_IGNORE_REGEX.match(path):
-            continue
+            # Special cases: exclude certain files
+            if path.startswith(CTAN_IGNORE_PREFIXES):
+                continue
+
+            date = int(date_str.replace("/", ""))
 
-        # Add the file entry to the filelist
-        if filename not in files:
-            files[filename] = []
-
-        files[filename].append(
-            FileEntry(
-                filename=filename,
-                path=path,
-                source="ctan",
-                date=date,
-                revision=None,
+            # Add the file entry to the filelist
+            files[filename].append(
+                FileEntry(filename, path, "ctan", date, None)
             )
-        )
+
+    # Make missing keys raise KeyError again for the callers.
+    files.default_factory = None
 
     return files
 
 
-def get_missing_ctan_files(
-    tlpdb_files: FileList,
+def partition_files(
+    all_tlpdb_files: FileList,
+    zip_tlpdb_files: FileList,
     ctan_files: FileList,
-) -> set[FileEntry]:
-    """Get the list of files that are in the tlpdb but not in the ctan filelist.
+) -> tuple[list[FileEntry], list[tuple[FileEntry, FileEntry]]]:
+    """Sort the tlpdb files by whether or not they're in the ctan filelist.
+
+    This is done in a single pass over the tlpdb filelist, since it's quite
+    large.
 
     Args:
-        tlpdb_files: The filelist extracted from the texlive.tlpdb file.
+        all_tlpdb_files: The filelist of all the files extracted from the
+            texlive.tlpdb file.
+        zip_tlpdb_files: The filelist of the files extracted from the
+            texlive.tlpdb file that may be included in the zip file.
         ctan_files: The filelist extracted from the FILES.byname file.
 
     Returns:
-        A set of FileEntry objects representing the files that are in the tlpdb
-        but not in the ctan filelist.
+        A tuple of the files that are missing and the files that are found.
+
+        The first item is a list of FileEntry objects representing the files
+        that should be included in the zip file since they're in the tlpdb but
+        not in the ctan filelist. Each filename appears at most once.
+
+        The second item is a list of (tlpdb entry, ctan entry) pairs
+        representing the files that are in both the tlpdb and the ctan filelist.
     """
 
-    missing = set(tlpdb_files.keys()) - set(ctan_files.keys())
-    out: set[FileEntry] = set()
+    missing: list[FileEntry] = []
+    found: list[tuple[FileEntry, FileEntry]] = []
+
+    for filename, tlpdb_entries in all_tlpdb_files.items():
+        ctan_entries = ctan_files.get(filename)
 
-    # Filter the missing files
-    for filename in missing:
-        # Ignore files with certain extensions since they're large and are meant
-        # to be included in the CTAN archive as-is.
-        extension = filename.split(".")[-1]
-        if extension in IGNORE_EXTENSIONS:
+        # The file is available from CTAN
+        if ctan_entries is not None:
+            # If there are multiple entries for this file, just ignore it since
+            # there's nothing sensible that we can do here.
+            if len(ctan_entries) > 1 or len(tlpdb_entries) > 1:
+                continue
+
+            found.append((tlpdb_entries[0], ctan_entries[0]))
             continue
 
-        # Now, get the FileEntry objects for this file
-        entries = tlpdb_files[filename]
+        # Otherwise, the file is missing from CTAN, so we'll need to put it in
+        # the zip file, if it's the type of file that we include there.
+        zip_entries = zip_tlpdb_files.get(filename)
+        if zip_entries is None:
+            continue
 
         # If there are duplicate entries for this file, just ignore it since
         # there's nothing sensible that we can do here.
-        if len(entries) > 1:
+        if len(zip_entries) > 1:
             continue
 
-        # Otherwise, add the single entry for this file to the output set.
-        out.add(entries[0])
+        # Otherwise, add the single entry for this file to the output list.
+        # The filelist keys are unique, so we don't need a set here.
+        missing.append(zip_entries[0])
 
-    return out
+    return missing, found
 
 
-def hash_file(texmf_dist: Path, path: str) -> bytes:
-    """Compute the hash of a file in the texmf-dist directory.
+def load_hash_cache(cache_path: Path) -> HashCache:
+    """Load the file hashes saved by a previous run.
 
     Args:
-        texmf_dist: The path to the texmf-dist directory on the local
-            filesystem.
-        path: The path to the file within texmf_dist.
+        cache_path: The path to the hash cache database.
+
+    Returns:
+        A dictionary mapping (path, size, modification time) tuples to the hash
+        of the file contents. Hashes computed with a different context or size
+        are ignored.
+    """
+
+    with closing(sqlite_connect(cache_path)) as db:
+        try:
+            rows = db.execute(
+                "SELECT path, size, mtime_ns, hash FROM hashes "
+                "WHERE context = ? AND hash_size = ?",
+                (LIBHYDROGEN_CONTEXT, HASH_SIZE_BYTES),
+            )
+        except OperationalError:
+            # The cache hasn't been created yet.
+            return {}
+        return {(path, size, mtime): hash for path, size, mtime, hash in rows}
+
+
+def save_hash_cache(cache_path: Path, cache: HashCache) -> None:
+    """Save the file hashes for use by the next run.
+
+    This replaces the entire contents of the cache, so that the hashes of any
+    files that were changed or removed since the last run don't accumulate.
+
+    Args:
+        cache_path: The path to the hash cache database.
+        cache: The hashes used in this run.
+    """
+
+    with closing(sqlite_connect(cache_path)) as db, db:
+        db.execute("DROP TABLE IF EXISTS hashes")
+        db.execute(
+            "CREATE TABLE hashes ("
+            "path TEXT, size INTEGER, mtime_ns INTEGER, "
+            "context BLOB, hash_size INTEGER, hash BLOB, "
+            "PRIMARY KEY (path, size, mtime_ns, context, hash_size))"
+        )
+        db.executemany(
+            "INSERT INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (*key, LIBHYDROGEN_CONTEXT, HASH_SIZE_BYTES, hash)
+                for key, hash in cache.items()
+            ),
+        )
+
+
+def hash_file(
+    path: Path, cache: HashCache, used_hashes: HashCache
+) -> bytes | None:
+    """Compute the hash of a file on the local filesystem.
+
+    This is called from worker threads, so it must not touch any shared state
+    other than the hash dictionaries, which are only ever updated atomically.
+
+    Args:
+        path: The path to the file.
+        cache: Hashes from previous runs, keyed on the file's path, size, and
+            modification time.
+        used_hashes: The hashes used in this run, with the same keys as the
+            cache. The file's hash is added to this.
 
     Returns:
-        The hash of the file contents, as bytes.
+        The hash of the file contents, as bytes, or None if the path is actually
+        a directory.
     """
 
-    with (texmf_dist / path).open("rb") as f:
-        contents = f.read()
-    return hash_message(contents)
+    # Directories are rare here, so it's cheaper to just try opening the path
+    # than to stat() every file first.
+    try:
+        f = path.open("rb")
+    except IsADirectoryError:
+        return None
+
+    with f:
+        stat = fstat(f.fileno())
+        key = (path.as_posix(), stat.st_size, stat.st_mtime_ns)
+
+        # Skip reading the file if it hasn't changed since the last run.
+        hash = cache.get(key)
+        if hash is not None:
+            used_hashes[key] = hash
+            return hash
+
+        if stat.st_size < MMAP_THRESHOLD:
+            # Small files are cheaper to just read directly.
+            hash = hash_message(f.read())
+        else:
+            # But for large files, we'll memory-map them and hash the pages in
+            # place to avoid copying the entire file into a bytes object first.
+            # The mapping needs to be writable for ctypes to accept it, so we
+            # use a private copy-on-write mapping; we never actually write to
+            # it, so no pages are copied.
+            with mmap(f.fileno(), 0, access=ACCESS_COPY) as mapped:
+                contents = (c_char * stat.st_size).from_buffer(mapped)
+                try:
+                    hash = hash_message(contents)
+                finally:
+                    # The mapping can't be closed while the array still
+                    # references it.
+                    del contents
+
+    used_hashes[key] = hash
+    return hash
 
 
 def get_found_ctan_files(
-    tlpdb_files: FileList,
-    ctan_files: FileList,
+    found: list[tuple[FileEntry, FileEntry]],
     texmf_dist: Path,
-) -> dict[str, CTANRow]:
-    """Get the list of files that are in both the tlpdb and the ctan filelist.
+    hash_cache: HashCache,
+    used_hashes: HashCache,
+) -> dict[str, DatabaseRow]:
+    """Get the database rows for the files that are in both filelists.
 
     Args:
-        tlpdb_files: The filelist extracted from the texlive.tlpdb file.
-        ctan_files: The filelist extracted from the FILES.byname file.
+        found: The (tlpdb entry, ctan entry) pairs for the files that are in
+            both the tlpdb and the ctan filelist, from partition_files().
         texmf_dist: The path to the texmf-dist directory on the local
             filesystem, used to compute the hashes of the files.
+        hash_cache: Hashes from previous runs.
+        used_hashes: The hashes of the files in this run are added to this, so
+            that they can be saved for the next run.
 
     Returns:
         A dictionary mapping file names to CTANRow objects representing the
         files that are in both the tlpdb and the ctan filelist.
     """
-    found = set(tlpdb_files.keys()).intersection(set(ctan_files.keys()))
-    out: dict[str, CTANRow] = {}
-
-    for filename in found:
-        # If there are multiple entries for this file, just ignore it since
-        # there's nothing sensible that we can do here.
-        if len(ctan_files[filename]) > 1 or len(tlpdb_files[filename]) > 1:
-            continue
-
-        # Get the entries for this file
-        ctan_entry = ctan_files[filename][0]
-        tlpdb_entry = tlpdb_files[filename][0]
+    pending: list[tuple[str, str, int]] = []
+    local_paths: list[Path] = []
 
+    for tlpdb_entry, ctan_entry in found:
         # If the revision is missing (shouldn't be possible), fail with an error
         if tlpdb_entry.revision is None:
             raise ValueError(
-                f"Revision is missing for file {filename} in tlpdb filelist."
+                f"Revision is missing for file {tlpdb_entry.filename} in tlpdb "
+                "filelist."
             )
 
-        # Otherwise, add the single entry for this file to the output list.
-        try:
-            out[filename] = CTANRow(
-                path=ctan_entry.path,
-                revision=tlpdb_entry.revision,
-                hash=hash_file(texmf_dist, tlpdb_entry.path),
-            )
-        except IsADirectoryError:
+        # Otherwise, queue the single entry for this file to be hashed.
+        pending.append((
+            tlpdb_entry.filename,
+            ctan_entry.path,
+            tlpdb_entry.revision,
+        ))
+        local_paths.append(texmf_dist / tlpdb_entry.path)
+
+    # Hash the files in parallel. Most of the time here is spent waiting on the
+    # disk or inside of libhydrogen, both of which release the GIL, so threads
+    # give us a decent speedup.
+    out: dict[str, DatabaseRow] = {}
+    with ThreadPoolExecutor(max_workers=WORKER_THREADS) as executor:
+        hashes = executor.map(
+            partial(hash_file, cache=hash_cache, used_hashes=used_hashes),
+            local_paths,
+        )
+        for (filename, path, revision), hash in zip(
+            pending, hashes, strict=True
+        ):
             # If the file is actually a directory, just skip it since we only
             # care about files.
-            continue
+            if hash is None:
+                continue
+
+            out[filename] = CTANRow(path=path, revision=revision, hash=hash)
 
     return out
 
 
-def get_zip_files(
-    tlpdb_files: FileList,
-    zip_path: Path,
-    texmf_dist: Path,
-) -> dict[str, ZipRow]:
-    """Get the list of files that are in the zip file.
+def deflate_file(path: Path) -> tuple[bytes, int, int] | None:
+    """Compress a file in the same way that it's stored in a zip file.
 
     Args:
-        tlpdb_files: The filelist extracted from the texlive.tlpdb file.
-        zip_path: The path to the zip file containing the missing files.
-        texmf_dist: The path to the texmf-dist directory on the local
-            filesystem, used to compute the hashes of the files.
+        path: The path to the file to compress.
 
     Returns:
-        A dictionary mapping file names to ZipRow objects representing the files
-        that are in the zip file.
+        A tuple containing the raw deflate-compressed data, the CRC-32 of the
+        uncompressed data, and the size of the uncompressed data, or None if
+        the path is a directory.
     """
 
-    zip_files: dict[str, ZipRow] = {}
+    # If the file is a directory, just skip it since we only care about files.
+    # Directories are rare here, so it's cheaper to just try opening everything
+    # than to stat() every file first.
+    try:
+        f = path.open("rb")
+    except IsADirectoryError:
+        return None
 
-    with Path(zip_path).open("rb") as f:
-        zip_bytes = f.read()
+    with f:
+        data = f.read()
 
-    with ZipFile(zip_path, "r") as zip_file:
-        for zip_info in zip_file.infolist():
-            filename = zip_info.filename
+    # Zip files use raw deflate streams, without any zlib header or trailer.
+    compressor = compressobj(COMPRESSION_LEVEL, DEFLATED, -MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
 
-            # We only care about files that are in the tlpdb filelist, but it
-            # should be impossible for a file to be missing from there.
-            try:
-                tlpdb_entry = tlpdb_files[filename][0]
-            except KeyError:
-                raise ValueError(
-                    f"File {filename} is in the zip file but not in the tlpdb filelist."
-                )
+    return compressed, crc32(data), len(data)
 
-            # The revision should also be present in the tlpdb filelist
-            revision = tlpdb_entry.revision
-            if revision is None:
-                raise ValueError(
-                    f"Revision is missing for file {filename} in tlpdb filelist."
-                )
 
-            # Get the byte offsets of the compressed file data in the zip file.
-            start_offset = (
-                zip_info.header_offset
-                + ZIP_LOCAL_FILE_HEADER_SIZE
-                + len(zip_info.filename)
-                + len(zip_info.extra)
-            )
-            end_offset = start_offset + zip_info.compress_size
+def deflate_and_hash(path: Path) -> tuple[bytes, int, int, bytes] | None:
+    """Compress a file for the zip file, and hash the compressed data.
 
-            # Now, add the entry for this file to the output dictionary.
-            zip_files[filename] = ZipRow(
-                path=filename,
-                revision=revision,
-                hash=hash_message(zip_bytes[start_offset : end_offset + 1]),
-                start_offset=start_offset,
-                end_offset=end_offset,
-            )
+    Args:
+        path: The path to the file to compress.
 
-    return zip_files
+    Returns:
+        The same tuple as deflate_file(), with the hash of the compressed data
+        appended, or None if the path is a directory.
+    """
+
+    deflated = deflate_file(path)
+    if deflated is None:
+        return None
+
+    compressed, crc, size = deflated
+    return compressed, crc, size, hash_message(compressed)
 
 
 def create_zip(
-    output_file: Path, texmf_dist: Path, files: set[FileEntry]
-) -> None:
+    output_file: Path, texmf_dist: Path, files: list[FileEntry]
+) -> dict[str, ZipRow]:
     """Create a zip file containing the specified files.
 
     Args:
         output_file: The path to the output zip file.
         texmf_dist: The path to the texmf-dist directory on the local filesystem.
-        files: The set of FileEntry objects representing the files to include in the zip file.
+        files: The list of FileEntry objects representing the files to include in the zip file.
+
+    Returns:
+        A dictionary mapping file names to ZipRow objects representing the files
+        that were written to the zip file.
     """
 
     # Sort the files to ensure deterministic output. We'll sort first by the
     # revision and then by the full path so that newer files are placed later
     # in the zip file, which should reduce the number of bytes changed with
     # every update.
-    sorted_files = sorted(
-        files,
-        key=lambda entry: (
+    # We build the sort keys directly into the list so that the sort can just
+    # compare tuples, which is faster than calling a key function. The filename
+    # is unique, so the entries themselves are never compared.
+    sorted_files = [
+        (
             entry.revision if entry.revision is not None else -1,
             entry.path,
-        ),
-    )
+            entry.filename,
+            entry,
+        )
+        for entry in files
+    ]
+    sorted_files.sort()
+
+    zip_files: dict[str, ZipRow] = {}
 
     # Delete the zip file first to make sure that we're starting from scratch.
     try:
@@ -720,14 +1111,45 @@ def create_zip(
     except FileNotFoundError:
         pass
 
-    with ZipFile(
-        output_file,
-        "w",
-        compression=ZIP_DEFLATED,
-        allowZip64=False,
-        compresslevel=9,
-    ) as zip_file:
-        for file in sorted_files:
+    with (
+        ZipFile(
+            output_file,
+            "w",
+            compression=ZIP_DEFLATED,
+            allowZip64=False,
+            compresslevel=COMPRESSION_LEVEL,
+        ) as zip_file,
+        ThreadPoolExecutor(max_workers=WORKER_THREADS) as executor,
+    ):
+        # ZipFile can't write data that's already compressed, so we'll write
+        # the entries to its file object ourselves. This relies on ZipFile's
+        # internal fp, filelist, NameToInfo, and start_dir attributes, which
+        # bypasses its _writecheck() and its writer lock; that's fine since
+        # only this thread ever writes to the zip file. The output has been
+        # checked to be byte-identical to ZipFile.writestr() on Python 3.11.
+        fp = zip_file.fp
+        assert fp is not None
+
+        # Compressing and hashing the files is the slow part, and both zlib and
+        # libhydrogen release the GIL while they're working, so we'll process
+        # the files concurrently and then write them to the zip file in order.
+        compressed_files = executor.map(
+            deflate_and_hash,
+            (texmf_dist / file.path for _, _, _, file in sorted_files),
+        )
+
+        for (_, _, _, file), compressed_file in zip(
+            sorted_files, compressed_files, strict=True
+        ):
+            if compressed_file is None:
+                continue
+            compressed, crc, size, hash = compressed_file
+
+            if file.revision is None:
+                raise ValueError(
+                    f"Revision is missing for file {file.filename} in tlpdb filelist."
+                )
+
             # Create a ZipInfo object for this file. We're avoiding using the
             # ZipFile.write() method since it doesn't allow us to specify the
             # date of the file.
@@ -752,70 +1174,86 @@ def create_zip(
             # to Unix.
             zip_info.create_system = 3
 
-            # Now, write the file to the zip file using the ZipInfo object and
-            # the contents of the file.
-            try:
-                with (texmf_dist / file.path).open("rb") as f:
-                    zip_file.writestr(
-                        zip_info,
-                        f.read(),
-                        compress_type=ZIP_DEFLATED,
-                        compresslevel=9,
-                    )
-            except IsADirectoryError:
-                # If the file is a directory, just skip it since we only care
-                # about files.
-                continue
+            zip_info.compress_type = ZIP_DEFLATED
+            zip_info.CRC = crc
+            zip_info.file_size = size
+            zip_info.compress_size = len(compressed)
+
+            # Write the local file header and the data, and then register the
+            # entry so that ZipFile adds it to the central directory.
+            zip_info.header_offset = fp.tell()
+            fp.write(zip_info.FileHeader(zip64=False))
+            start_offset = fp.tell()
+            fp.write(compressed)
+            zip_file.filelist.append(zip_info)
+            zip_file.NameToInfo[zip_info.filename] = zip_info
+            zip_file.start_dir = fp.tell()
+
+            # Since we wrote the entry ourselves, we already know exactly where
+            # the compressed data is, so we don't need to read the zip file back
+            # in to generate the database rows.
+            zip_files[file.filename] = ZipRow(
+                path=file.filename,
+                revision=file.revision,
+                hash=hash,
+                start_offset=start_offset,
+                end_offset=start_offset + len(compressed) - 1,
+            )
 
+    return zip_files
 
-def save_database(
-    output_file: Path,
-    files: dict[str, DatabaseRow],
-    secret_key: bytes,
-) -> None:
-    """Save the database to a compressed Lua table.
 
-    Args:
-        output_file: The path to the output Lua file.
+def lua_database(files: dict[str, DatabaseRow]) -> Iterator[bytes]:
+    """Generate the database as a Lua table.
 
+    Args:
         files: The dictionary of DatabaseRow objects representing the files to
             include in the database.
 
-        secret_key: The secret key to use for signing the database, as bytes.
+    Yields:
+        The Lua source code of the database, one row at a time.
     """
 
-    # Sort by revision and then by path to ensure deterministic output.
-    sorted_files = sorted(
-        files.items(),
-        key=lambda row: (
-            row[1].revision,
-            row[1].path,
-        ),
-    )
-
-    output = [
-        b"return {",
+    # Sort by revision and then by path to ensure deterministic output. As in
+    # create_zip(), we build the sort keys directly into the list for speed.
+    sorted_files = [
+        (row.revision, row.path, filename, row)
+        for filename, row in files.items()
     ]
+    sorted_files.sort()
+
+    # This key is the same for every zip row, so only convert it once.
+    offset_key = lua_key("offset")
+
+    # Many files share the same revision, so we'll cache the encoded revisions.
+    encoded_revisions: dict[int, bytes] = {}
+
+    yield b"return {"
+
+    for _, _, filename, row in sorted_files:
+        revision = encoded_revisions.get(row.revision)
+        if revision is None:
+            revision = str(row.revision).encode()
+            encoded_revisions[row.revision] = revision
 
-    for filename, row in sorted_files:
         # fmt: off
         if isinstance(row, CTANRow):
-            output += [
+            output = [
                 lua_key(filename), b"={",
                     b'source="ctan",',
                     b"path=", lua_string(row.path), b",",
-                    b"revision=", str(row.revision).encode(), b",",
+                    b"revision=", revision, b",",
                     b"hash=", lua_string(row.hash),
                 b"},",
             ]
         elif isinstance(row, ZipRow):
-            output += [
+            output = [
                 lua_key(filename), b"={",
                     b'source="zip",',
                     b"path=", lua_string(row.path), b",",
-                    b"revision=", str(row.revision).encode(), b",",
+                    b"revision=", revision, b",",
                     b"hash=", lua_string(row.hash), b",",
-                    lua_key("offset"), b"=", b"{",
+                    offset_key, b"=", b"{",
                         str(row.start_offset).encode(), b",",
                         str(row.end_offset).encode(),
                     b"}",
@@ -824,13 +1262,40 @@ def save_database(
         else:
             raise ValueError(f"Invalid row type for file {filename}.")
         # fmt: on
-    output.append(b"}")
+        yield b"".join(output)
+
+    yield b"}"
+
+
+def save_database(
+    output_file: Path,
+    files: dict[str, DatabaseRow],
+    secret_key: bytes,
+) -> None:
+    """Save the database to a compressed Lua table.
+
+    Args:
+        output_file: The path to the output Lua file.
 
-    # Join the lines into a single string and encode it as bytes.
-    data = b"".join(output)
+        files: The dictionary of DatabaseRow objects representing the files to
+            include in the database.
 
-    # Compress the data using gzip.
-    compressed_data = gzip_compress(data, compresslevel=9)
+        secret_key: The secret key to use for signing the database, as bytes.
+    """
+
+    # Compress the database
+    if zopfli_compress is not None:
+        # Zopfli can only compress all the data at once.
+        compressed_data = zopfli_compress(b"".join(lua_database(files)))
+    else:
+        # Otherwise, compress the data as we generate it, so that we never need
+        # to hold the entire uncompressed database in memory.
+        compressed = BytesIO()
+        with GzipFile(
+            fileobj=compressed, mode="wb", compresslevel=COMPRESSION_LEVEL
+        ) as gz:
+            gz.writelines(lua_database(files))
+        compressed_data = compressed.getvalue()
 
     # Sign the compressed data
     signature = create_signature(compressed_data, secret_key)
@@ -861,28 +1326,34 @@ def run(  # noqa: PLR0917 PLR0913
         secret_key: The secret key to use for encryption, as bytes.
     """
 
-    # Download the files
-    ctan, tlpdb = download_files(mirror_url)
+    # Download and extract the filelists. These are large, so we'll keep a copy
+    # of them to avoid downloading them again if they haven't changed.
+    ctan_files, (all_tlpdb_files, zip_tlpdb_files) = download_filelists(
+        mirror_url=mirror_url,
+        cache_directory=output_directory / DOWNLOAD_CACHE_NAME,
+    )
 
-    # Extract the filelists
-    ctan_files = filelist_from_ctan(ctan)
-    all_tlpdb_files, zip_tlpdb_files = filelist_from_tlpdb(tlpdb)
+    # Get the lists of files in TL that are and aren't in CTAN
+    ctan_missing, ctan_found_entries = partition_files(
+        all_tlpdb_files=all_tlpdb_files,
+        zip_tlpdb_files=zip_tlpdb_files,
+        ctan_files=ctan_files,
+    )
 
+    zip_files: dict[str, ZipRow] = {}
     if generate_zip:
         msg("Generating zip file...")
-        # Get the list of files in TL but not in CTAN
-        ctan_missing = get_missing_ctan_files(zip_tlpdb_files, ctan_files)
 
         # Generate the zip file containing the missing files
         output_directory.mkdir(parents=True, exist_ok=True)
-        create_zip(
+        zip_files = create_zip(
             output_file=output_directory / ZIP_NAME,
             texmf_dist=texmf_dist,
             files=ctan_missing,
         )
 
         msg(
-            f"Finished generating zip file. {len(ctan_missing)} files were included."
+            f"Finished generating zip file. {len(zip_files)} files were included."
         )
 
     if generate_database:
@@ -892,22 +1363,24 @@ def run(  # noqa: PLR0917 PLR0913
             )
         msg("Generating database...")
 
-        # Get the list of files needed
+        # Get the list of files needed. Hashing all the files is slow, so we'll
+        # reuse the hashes from the previous run for any unchanged files.
+        hash_cache_path = output_directory / HASH_CACHE_NAME
+        used_hashes: HashCache = {}
         ctan_found = get_found_ctan_files(
-            tlpdb_files=all_tlpdb_files,
-            ctan_files=ctan_files,
-            texmf_dist=texmf_dist,
-        )
-        zip_files = get_zip_files(
-            tlpdb_files=zip_tlpdb_files,
-            zip_path=output_directory / ZIP_NAME,
+            found=ctan_found_entries,
             texmf_dist=texmf_dist,
+            hash_cache=load_hash_cache(hash_cache_path),
+            used_hashes=used_hashes,
         )
+        save_hash_cache(hash_cache_path, used_hashes)
 
-        # Generate the filename database and save it to a file.
+        # Generate the filename database and save it to a file. We don't need
+        # the CTAN rows on their own anymore, so we can merge in place.
+        ctan_found.update(zip_files)
         save_database(
             output_file=output_directory / DATABASE_FILENAME,
-            files=ctan_found | zip_files,
+            files=ctan_found,
             secret_key=secret_key,
         )
         msg("Finished generating database.")